@@ -3,14 +3,18 @@
 from __future__ import annotations
 
 import argparse
+import configparser
 import os
 import socket
 import sqlite3
+import stat
 import sys
+from contextlib import closing
 from datetime import datetime
 from pathlib import Path
 from textwrap import dedent, indent
 from typing import NamedTuple
+from urllib.parse import quote
 
 app_name = "fbx.py"
 
@@ -20,6 +24,11 @@ app_title = f"{app_name} (v{__version__})"
 
 run_dt = datetime.now()
 
+run_dt_str = run_dt.strftime("%Y-%m-%d %H:%M")
+
+#  Buffer size for the output files, so each is written in a few large chunks.
+out_buffering = 1 << 20
+
 
 class AppOptions(NamedTuple):
     places_file: Path
@@ -165,6 +174,82 @@ def get_args(arglist=None):
     return ap.parse_args(arglist)
 
 
+def file_mtime(file_path: Path) -> float | None:
+    """
+    Returns the modified time of the file, or None if it is not a file.
+    """
+    try:
+        st = file_path.stat()
+    except OSError:
+        return None
+    return st.st_mtime if stat.S_ISREG(st.st_mode) else None
+
+
+def find_places_file(profiles_dir: Path) -> Path | None:
+    """
+    Returns the most recently modified 'places.sqlite' file in the given
+    folder, or in one of its immediate sub-folders. Firefox keeps each
+    profile in its own folder directly under the 'Profiles' folder, so
+    there is no need to search the whole tree.
+    """
+    candidates = [profiles_dir / "places.sqlite"]
+    with os.scandir(profiles_dir) as entries:
+        candidates.extend(
+            Path(entry.path) / "places.sqlite" for entry in entries if entry.is_dir()
+        )
+
+    #  Single pass, one stat() per candidate.
+    newest = None
+    newest_mtime = 0.0
+    for file_path in candidates:
+        mtime = file_mtime(file_path)
+        if mtime is not None and (newest is None or mtime > newest_mtime):
+            newest = file_path
+            newest_mtime = mtime
+    return newest
+
+
+def get_ini_places_file(ini_file: Path) -> Path | None:
+    """
+    Returns the path to the 'places.sqlite' file in the default profile
+    listed in Firefox's 'profiles.ini' file. The default for an install
+    ([Install...] sections) takes precedence over a [Profile...] section
+    marked Default=1. Returns None if there is no 'profiles.ini' file, no
+    default profile is listed, the file cannot be read or parsed, or the
+    profile has no 'places.sqlite' file.
+    """
+    if not ini_file.is_file():
+        return None
+
+    cfg = configparser.ConfigParser(interpolation=None)
+    try:
+        cfg.read(ini_file, encoding="utf-8")
+    except (configparser.Error, UnicodeDecodeError, OSError):
+        return None
+
+    profile_dir = None
+
+    for section in cfg.sections():
+        if section.startswith("Install") and cfg[section].get("Default"):
+            profile_dir = ini_file.parent / cfg[section]["Default"]
+            break
+    else:
+        for section in cfg.sections():
+            sect = cfg[section]
+            if section.startswith("Profile") and sect.get("Default") == "1":
+                if sect.get("IsRelative", "1") == "1":
+                    profile_dir = ini_file.parent / sect.get("Path", "")
+                else:
+                    profile_dir = Path(sect.get("Path", ""))
+                break
+
+    if profile_dir is None:
+        return None
+
+    places_file = profile_dir / "places.sqlite"
+    return places_file if places_file.is_file() else None
+
+
 def get_opts(arglist=None):  # noqa: PLR0912, PLR0915
     args = get_args(arglist)
 
@@ -190,21 +275,27 @@ def get_opts(arglist=None):  # noqa: PLR0912, PLR0915
             else:
                 windows_appdata = os.getenv("APPDATA")
                 if windows_appdata:
-                    p = Path(windows_appdata) / "Mozilla" / "Firefox" / "Profiles"
+                    ff_dir = Path(windows_appdata) / "Mozilla" / "Firefox"
+                    p = ff_dir / "Profiles"
                 else:
-                    p = Path("~/.mozilla/firefox").expanduser().resolve()
+                    ff_dir = Path("~/.mozilla/firefox").expanduser().resolve()
+                    p = ff_dir
+                #  Use the default profile listed in 'profiles.ini', if any.
+                places_file = get_ini_places_file(ff_dir / "profiles.ini")
 
-            if not p.exists():
+            if not p.is_dir():
                 sys.stderr.write(f"\nERROR: Cannot find folder '{p}'\n")
                 sys.exit(1)
 
-            files = list(p.glob("**/places.sqlite"))
-            files.sort(key=lambda x: x.stat().st_mtime)
-            places_file = files[-1]
+            if places_file is None:
+                places_file = find_places_file(p)
+            if places_file is None:
+                sys.stderr.write(f"\nERROR: Cannot find 'places.sqlite' in '{p}'\n")
+                sys.exit(1)
 
         if places_file:
             if not places_file.exists():
-                sys.stderr.write(f"\nERROR: Cannot find folder '{p}'\n")
+                sys.stderr.write(f"\nERROR: Cannot find '{places_file}'\n")
                 sys.exit(1)
         else:
             sys.stderr.write("\nERROR: No profile or file name specified.'\n")
@@ -275,8 +366,7 @@ def get_opts(arglist=None):  # noqa: PLR0912, PLR0915
     )
 
 
-def html_style():
-    s = """
+html_css = """
         body {
             background-color: oldlace;
             font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
@@ -307,46 +397,80 @@ def html_style():
             font-size: x-small;
             margin-top: 2rem;
         }
+""".lstrip("\n").rstrip()
+
+html_head_fmt = dedent(
+    """
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta name="generator" content="{0}">
+        <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+        <title>{1}</title>
+        <style>
+    {2}
+        </style>
+        <base target="_blank">
+    </head>
+    <body>
+    <h1>{1}</h1>
+    <ul>
     """
-    return s.lstrip("\n").rstrip()
+).strip("\n")
 
 
-def html_head(title):
-    return (
-        dedent(
-            """
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta name="generator" content="{0}">
-            <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
-            <title>{1}</title>
-            <style>
-        {2}
-            </style>
-            <base target="_blank">
-        </head>
-        <body>
-        <h1>{1}</h1>
-        <ul>
-        """
-        )
-        .format(app_name, title, html_style())
-        .strip("\n")
-    )
+html_tail_fmt = dedent(
+    """
+    </ul>
+    <div id="footer">
+      Created {0} by {1}.
+    </div>
+    </body>
+    </html>
+    """
+)
 
+#  Per-bookmark list item templates, already dedented and indented so only
+#  format() is needed for each bookmark.
+html_li_fmt = indent(
+    dedent(
+        """
+        <li>
+            <p>
+            <span class="bookmark-title">{1}</span><br />
+            <span class="bookmark-path">{0}</span><br />
+            <a href="{2}">{2}</a><br />
+            <span class="added-dt">Added {3}</span>
+            </p>
+        </li>
+        """
+    ),
+    " " * 8,
+)
 
-def html_tail():
-    return dedent(
+html_bydate_li_fmt = indent(
+    dedent(
         """
-        </ul>
-        <div id="footer">
-          Created {0} by {1}.
-        </div>
-        </body>
-        </html>
+        <li>
+            <p>
+            <span class="bookmark-title">{1}</span><br />
+            <span class="bookmark-path">{0}</span><br />
+            <a href="{2}">{2}</a><br />
+            <span class="added-dt">Added {3}{4}</span>
+            </p>
+        </li>
         """
-    ).format(run_dt.strftime("%Y-%m-%d %H:%M"), app_title)
+    ),
+    " " * 8,
+)
+
+
+def html_head(title):
+    return html_head_fmt.format(app_name, title, html_css)
+
+
+def html_tail():
+    return html_tail_fmt.format(run_dt_str, app_title)
 
 
 def limited(value):
@@ -357,6 +481,15 @@ def limited(value):
     return s[:177] + "..."
 
 
+def ascii_text(text: str) -> str:
+    """
+    Replaces non-ASCII characters with backslash escapes (such as '\\xe9').
+    Unlike ascii(), the text is not wrapped in quotes, and quotes and
+    backslashes already in the text are left as they are.
+    """
+    return text.encode("ascii", "backslashreplace").decode("ascii")
+
+
 def htm_txt(text: str) -> str:
     s = text.replace("&", "&amp;")
     s = s.replace("<", "&lt;")
@@ -367,54 +500,83 @@ def htm_url(url: str) -> str:
     return url.replace("&", "%26")
 
 
-def write_bookmarks_html(html_file: Path, bmks: list[Bookmark], cp_dir: Path):
+def write_bookmarks_outputs(
+    html_file: Path, bmks: list[Bookmark], cp_dir: Path, md_file: Path | None = None
+):
+    """
+    Writes the HTML file, and the Markdown file if md_file is given,
+    listing the bookmarks by host, folder path, and title. Both files
+    are written in the same pass, so the list is sorted once and each
+    bookmark's escaped folder path and URL are computed once for both.
+    """
     print(f"Writing '{html_file}'")
+    if md_file:
+        print(f"Writing '{md_file}'")
+
+    #  One pass with a tuple key. The key function runs once per item, so
+    #  each lower() is computed only once.
+    bmks.sort(
+        key=lambda item: (
+            item.host_name.lower(),
+            item.parent_path.lower(),
+            item.title.lower(),
+        )
+    )
 
-    #  https://docs.python.org/3/howto/sorting.html#sort-stability-and-complex-sorts
-    bmks.sort(key=lambda item: item.title.lower())
-    bmks.sort(key=lambda item: item.parent_path.lower())
-    bmks.sort(key=lambda item: item.host_name.lower())
-
-    with html_file.open("w", encoding="utf-8") as f:
-        f.write(html_head("Bookmarks"))
+    parts = [html_head("Bookmarks")]
+    md_parts = ["# Bookmarks\n\n"]
 
-        last_host = ""
+    last_host = ""
 
-        for bmk in bmks:
-            assert bmk.host_name  # noqa: S101
-            assert bmk.asof_dt  # noqa: S101
+    for bmk in bmks:
+        assert bmk.host_name  # noqa: S101
+        assert bmk.asof_dt  # noqa: S101
 
-            if bmk.host_name != last_host:
-                f.write(
-                    f"<div class=\"asof\">On host '{bmk.host_name}' "
-                    f"as of {bmk.asof_dt}</div>\n"
+        if bmk.host_name != last_host:
+            parts.append(
+                f"<div class=\"asof\">On host '{bmk.host_name}' "
+                f"as of {bmk.asof_dt}</div>\n"
+            )
+            if md_file:
+                md_parts.append(
+                    f"On host **{bmk.host_name}** as of **{bmk.asof_dt}**\n\n"
                 )
-                last_host = bmk.host_name
-
-            title = bmk.title.strip()
-            s = dedent(
-                """
-                    <li>
-                        <p>
-                        <span class="bookmark-title">{1}</span><br />
-                        <span class="bookmark-path">{0}</span><br />
-                        <a href="{2}">{2}</a><br />
-                        <span class="added-dt">Added {3}</span>
-                        </p>
-                    </li>
-                    """
-            ).format(
-                htm_txt(bmk.parent_path),
-                htm_txt(title),
-                htm_url(bmk.url),
-                bmk.when_added,
+            last_host = bmk.host_name
+
+        safe_path = htm_txt(bmk.parent_path)
+        safe_url = htm_url(bmk.url)
+
+        title = bmk.title.strip()
+        parts.append(
+            html_li_fmt.format(safe_path, htm_txt(title), safe_url, bmk.when_added)
+        )
+
+        if md_file:
+            md_title = limited(ascii_text(bmk.title))
+            md_parts.append(
+                f"[{htm_txt(md_title)}]({safe_url})\n"
+                f"Added: `{bmk.when_added}`\n"
+                f"Folder: `{safe_path}`\n\n"
             )
-            f.write(indent(s, " " * 8))
-        f.write(html_tail())
+
+    parts.append(html_tail())
+
+    with html_file.open("w", encoding="utf-8", buffering=out_buffering) as f:
+        f.writelines(parts)
     if cp_dir:
         cp_file = cp_dir / html_file.name
         print(f"Copying to '{cp_file}'")
-        cp_file.write_text(html_file.read_text())
+        cp_file.write_bytes(html_file.read_bytes())
+
+    if md_file:
+        md_parts.append("---\n\nCreated {0} by {1}".format(run_dt_str, app_title))
+
+        with md_file.open("w", encoding="utf-8", buffering=out_buffering) as f:
+            f.writelines(md_parts)
+        if cp_dir:
+            cp_file = cp_dir / md_file.name
+            print(f"Copying to '{cp_file}'")
+            cp_file.write_bytes(md_file.read_bytes())
 
 
 def write_bookmarks_by_date_html(
@@ -422,90 +584,47 @@ def write_bookmarks_by_date_html(
 ):
     print(f"Writing '{html_file}'")
 
-    #  Re-sort bookmarks list.
-    bmks.sort(key=lambda item: item.host_name.lower())
-    bmks.sort(key=lambda item: item.url)
+    #  Re-sort bookmarks list. The string keys cannot be negated, so descending
+    #  when_added takes a second (stable) pass over the ascending tie-breakers.
+    #  https://docs.python.org/3/howto/sorting.html#sort-stability-and-complex-sorts
+    bmks.sort(key=lambda item: (item.url, item.host_name.lower()))
     bmks.sort(key=lambda item: item.when_added, reverse=True)
 
-    with html_file.open("w") as f:
-        f.write(html_head("Bookmarks by Date Added"))
+    parts = [html_head("Bookmarks by Date Added")]
+
+    if n_hosts > 1:
+        parts.append('<div class="asof">\n')
+        parts.append("Combined bookmarks from multiple hosts.\n</div>\n")
+    elif bmks:
+        parts.append(
+            f'<div class="asof">On host {bmks[0].host_name} '
+            f"as of {bmks[0].asof_dt}</div>\n"
+        )
+
+    host_str = ""
 
+    for bmk in bmks:
         if n_hosts > 1:
-            f.write('<div class="asof">\n')
-            f.write("Combined bookmarks from multiple hosts.\n</div>\n")
-        elif bmks:
-            f.write(
-                f'<div class="asof">On host {bmks[0].host_name} '
-                f"as of {bmks[0].asof_dt}</div>\n"
-            )
+            host_str = f"&nbsp;&nbsp;&nbsp;({bmk.host_name})"
 
-        host_str = ""
-
-        for bmk in bmks:
-            if n_hosts > 1:
-                host_str = f"&nbsp;&nbsp;&nbsp;({bmk.host_name})"
-
-            title = limited(ascii(bmk.title))
-            s = dedent(
-                """
-                    <li>
-                        <p>
-                        <span class="bookmark-title">{1}</span><br />
-                        <span class="bookmark-path">{0}</span><br />
-                        <a href="{2}">{2}</a><br />
-                        <span class="added-dt">Added {3}{4}</span>
-                        </p>
-                    </li>
-                    """
-            ).format(
+        title = limited(bmk.title)
+        parts.append(
+            html_bydate_li_fmt.format(
                 htm_txt(bmk.parent_path),
                 htm_txt(title),
                 htm_url(bmk.url),
                 bmk.when_added,
                 host_str,
             )
-            f.write(indent(s, " " * 8))
-        f.write(html_tail())
-    if cp_dir:
-        cp_file = cp_dir / html_file.name
-        print(f"Copying to '{cp_file}'")
-        cp_file.write_text(html_file.read_text())
-
-
-def write_bookmarks_markdown(md_file: Path, bmks: list[Bookmark], cp_dir: Path):
-    print(f"Writing '{md_file}'")
-
-    bmks.sort(key=lambda item: item.title.lower())
-    bmks.sort(key=lambda item: item.parent_path.lower())
-    bmks.sort(key=lambda item: item.host_name.lower())
-
-    with md_file.open("w") as f:
-        f.write("# Bookmarks\n\n")
-
-        last_host = ""
-
-        for bmk in bmks:
-            if bmk.host_name != last_host:
-                f.write(f"On host **{bmk.host_name}** as of **{bmk.asof_dt}**\n\n")
-                last_host = bmk.host_name
-
-            title = limited(ascii(bmk.title)).strip("'")
-
-            f.write(
-                f"[{htm_txt(title)}]({htm_url(bmk.url)})\n"
-                f"Added: `{bmk.when_added}`\n"
-                f"Folder: `{htm_txt(bmk.parent_path)}`\n\n"
-            )
-
-        f.write(
-            "---\n\nCreated {0} by {1}".format(
-                run_dt.strftime("%Y-%m-%d %H:%M"), app_title
-            )
         )
+    parts.append(html_tail())
+
+    with html_file.open("w", encoding="utf-8", buffering=out_buffering) as f:
+        f.writelines(parts)
     if cp_dir:
-        cp_file = cp_dir / md_file.name
+        cp_file = cp_dir / html_file.name
         print(f"Copying to '{cp_file}'")
-        cp_file.write_text(md_file.read_text())
+        cp_file.write_bytes(html_file.read_bytes())
 
 
 def write_bookmarks_markdown_by_date(
@@ -514,84 +633,75 @@ def write_bookmarks_markdown_by_date(
     print(f"Writing '{md_file}'")
 
     #  Re-sort bookmarks list. Ascending when_added for Markdown output.
-    bmks.sort(key=lambda item: item.host_name.lower())
-    bmks.sort(key=lambda item: item.url)
-    bmks.sort(key=lambda item: item.when_added)
+    bmks.sort(key=lambda item: (item.when_added, item.url, item.host_name.lower()))
 
-    with md_file.open("w") as f:
-        f.write("# Bookmarks by Date Added\n\n")
+    parts = ["# Bookmarks by Date Added\n\n"]
 
-        if n_hosts > 1:
-            f.write("(Combined bookmarks from multiple hosts.)\n\n")
-        elif bmks:
-            f.write(f"On host **{bmks[0].host_name}** as of **{bmks[0].asof_dt}**.\n\n")
+    if n_hosts > 1:
+        parts.append("(Combined bookmarks from multiple hosts.)\n\n")
+    elif bmks:
+        parts.append(
+            f"On host **{bmks[0].host_name}** as of **{bmks[0].asof_dt}**.\n\n"
+        )
 
-        host_str = ""
+    host_str = ""
 
-        for bmk in bmks:
-            if n_hosts > 1:
-                host_str = f"Host: `{bmk.host_name}`\n"
+    for bmk in bmks:
+        if n_hosts > 1:
+            host_str = f"Host: `{bmk.host_name}`\n"
 
-            title = limited(ascii(bmk.title)).strip("'")
+        title = limited(ascii_text(bmk.title))
 
-            f.write(
-                f"[{htm_txt(title)}]({htm_url(bmk.url)})\n"
-                f"Added: `{bmk.when_added}`\n"
-                f"Folder: `{htm_txt(bmk.parent_path)}`\n{host_str}\n"
-            )
-
-        f.write(
-            "---\n\nCreated {0} by {1}".format(
-                run_dt.strftime("%Y-%m-%d %H:%M"), app_title
-            )
+        parts.append(
+            f"[{htm_txt(title)}]({htm_url(bmk.url)})\n"
+            f"Added: `{bmk.when_added}`\n"
+            f"Folder: `{htm_txt(bmk.parent_path)}`\n{host_str}\n"
         )
+
+    parts.append("---\n\nCreated {0} by {1}".format(run_dt_str, app_title))
+
+    with md_file.open("w", encoding="utf-8", buffering=out_buffering) as f:
+        f.writelines(parts)
     if cp_dir:
         cp_file = cp_dir / md_file.name
         print(f"Copying to '{cp_file}'")
-        cp_file.write_text(md_file.read_text())
+        cp_file.write_bytes(md_file.read_bytes())
 
 
-def get_parent_path(con, bookmark_parent_id):
-    cur = con.cursor()
-    max_depth = 99
-    depth = 0
-    parent_id = bookmark_parent_id
-    parent_path = "/"
-    while parent_id > 0:
-        #  It appears that the root always has id=0. If that is not the case
-        #  this max-depth check (99 seems like a good arbitrary value) will
-        #  prevent an infinate loop.
-        depth += 1
-        if depth > max_depth:
-            print("ERROR: parent_path max depth exceeded.")
-            return f"/(ERROR){parent_path}"
-
-        qry = (  # noqa: S608
-            "SELECT parent, title FROM moz_bookmarks WHERE id = {0}"
-        ).format(parent_id)
-
-        cur.execute(qry)
-        rows = cur.fetchall()
-        assert len(rows) == 1  # noqa: S101
-
-        parent_id = int(rows[0][0])
-        if parent_id > 0:
-            title = str(rows[0][1])
-            parent_path = f"/{title}{parent_path}"
-
-    return parent_path
-
-
-def from_moz_date(moz_date) -> str:
+def sqlite_uri(db_file: Path, query: str) -> str:
     """
-    The date values in the Mozilla sqlite database are in microseconds
-    since the Unix epoch. This function converts the moz_date value to
-    seconds, then to the equivalent datetime value.
-    The date time value is returned as a formatted string.
+    Returns a SQLite URI for the file with the given query string. The
+    whole path is percent-encoded, so the URI never has an authority part.
+    Path.as_uri() turns a UNC path (such as an APPDATA folder redirected
+    to a network share) into 'file://server/share/...', which SQLite
+    rejects.
     """
-    dt_secs = moz_date / 1000000.0
-    dt = datetime.fromtimestamp(dt_secs)
-    return dt.strftime("%Y-%m-%d %H:%M:%S")
+    return f"file:{quote(os.fspath(db_file), safe='')}?{query}"
+
+
+def connect_places(places_file: Path, immutable: bool = False) -> sqlite3.Connection:
+    """
+    Opens the places.sqlite database for reading. The busy timeout gives
+    Firefox time to finish a write if it is running. Firefox already keeps
+    the database in WAL mode, so no journal PRAGMAs are changed here.
+
+    The file is opened read-write (mode=rw, so a missing file is not
+    created), with PRAGMA query_only to prevent changes. With mode=ro,
+    SQLite cannot remove the WAL and shared-memory files it creates next
+    to a WAL-mode database, so 'places.sqlite-wal' and 'places.sqlite-shm'
+    would be left behind. A write-protected file is still opened read-only.
+
+    If immutable is True, SQLite is told the file cannot change, so no
+    locks are taken at all. That allows reading the database while Firefox
+    holds it locked, but changes not yet checkpointed from the WAL file
+    are not seen.
+    """
+    uri = sqlite_uri(places_file, "mode=ro&immutable=1" if immutable else "mode=rw")
+    con = sqlite3.connect(uri, uri=True, timeout=5.0)
+    con.execute("PRAGMA query_only = ON;")
+    #  Read pages through a memory map (up to 256 MiB) instead of read() calls.
+    con.execute("PRAGMA mmap_size = 268435456;")
+    return con
 
 
 def get_bookmarks(con: sqlite3.Connection, host_name: str, asof: str) -> list[Bookmark]:
@@ -600,70 +710,112 @@ def get_bookmarks(con: sqlite3.Connection, host_name: str, asof: str) -> list[Bo
     list of bookmarks as Bookmark (namedtuple) items.
     The list is sorted by parent path and title.
     """
-    bookmarks = []
-
+    #  The recursive CTE walks down from the root (parent = 0) to build the
+    #  full path of every folder in one query, instead of walking up the
+    #  parent chain with a separate query for each bookmark. The depth limit
+    #  (99 seems like a good arbitrary value) prevents an infinite loop if
+    #  the table is not a proper tree. Bookmarks in a folder that is nested
+    #  too deep, or not connected to the root, get an '/(ERROR)/' path.
     qry = dedent(
         """
+        WITH RECURSIVE parents(id, path, depth) AS (
+            SELECT id, '/', 0
+            FROM moz_bookmarks
+            WHERE parent = 0
+            UNION ALL
+            SELECT b.id, p.path || ifnull(b.title, '') || '/', p.depth + 1
+            FROM moz_bookmarks b
+            JOIN parents p
+            ON b.parent = p.id
+            WHERE p.depth < 99
+        )
         SELECT
             b.title,
             p.url,
-            b.parent,
-            b.dateAdded
+            ifnull(par.path, '/(ERROR)/'),
+            strftime(
+                '%Y-%m-%d %H:%M:%S', b.dateAdded / 1000000, 'unixepoch', 'localtime'
+            )
         FROM
             moz_bookmarks b
         JOIN moz_places p
         ON p.id = b.fk
+        LEFT JOIN parents par
+        ON par.id = b.parent
+        WHERE substr(p.url, 1, 4) = 'http'
+        ORDER BY par.path COLLATE NOCASE, b.title COLLATE NOCASE
         """
     )
 
     cur = con.cursor()
+    cur.execute(qry)
 
-    try:
-        cur.execute(qry)
-    except Exception as ex:
-        if str(ex) == "database is locked":
-            cur.close()
-            con.close()
-            sys.stderr.write(
-                "\nERROR: Database is locked. Please close Firefox and try again.\n"
-            )
-            sys.exit(1)
-        else:
-            raise ex
-
-    rows = cur.fetchall()
-
-    for row in rows:
-        url = str(row[1])
-
-        if not url.startswith("http"):
-            print(f"SKIP NON-HTTP URL: '{url}'")
-            continue
-
-        title = str(row[0])
-        parent_id = int(row[2])
-
-        if title is None:
-            title = f"({url})"
+    #  The sqlite3 module already returns TEXT as str, so no coercion is
+    #  needed. A bookmark with no title (NULL) is shown by its URL. The
+    #  date-added value (microseconds since the Unix epoch) is formatted as
+    #  local time by SQLite, to avoid creating a datetime for every row.
+    bookmarks = [
+        Bookmark(
+            f"({url})" if title is None else title,
+            url,
+            parent_path,
+            when_added,
+            host_name,
+            asof,
+        )
+        for title, url, parent_path, when_added in cur
+    ]
 
-        when_added = from_moz_date(row[3])
+    n_errors = sum(1 for bmk in bookmarks if bmk.parent_path == "/(ERROR)/")
+    if n_errors:
+        print(
+            f"ERROR: Cannot find the folder path for {n_errors} bookmarks "
+            "(max depth exceeded or not connected to the root)."
+        )
 
-        bookmarks.append(
-            Bookmark(
-                title,
-                url,
-                get_parent_path(con, parent_id),
-                when_added,
-                host_name,
-                asof,
-            )
+    #  Report the number of bookmarks left out by the 'http' filter in one
+    #  line, rather than printing each skipped URL.
+    cur.execute(
+        dedent(
+            """
+            SELECT count(*)
+            FROM moz_bookmarks b
+            JOIN moz_places p
+            ON p.id = b.fk
+            WHERE substr(p.url, 1, 4) <> 'http'
+            """
         )
+    )
+    n_skipped = cur.fetchone()[0]
+    if n_skipped:
+        print(f"Skipped {n_skipped} non-http URLs.")
 
-    con.rollback()  # Should be no changes, but just in case...
     cur.close()
     return bookmarks
 
 
+def read_places_bookmarks(
+    places_file: Path, host_name: str, asof: str
+) -> list[Bookmark]:
+    """
+    Reads the bookmarks from the places.sqlite file. If Firefox has the
+    database locked, it is read again as immutable (without locking).
+    """
+    con = connect_places(places_file)
+    try:
+        bookmarks = get_bookmarks(con, host_name, asof)
+    except sqlite3.OperationalError as ex:
+        if str(ex) != "database is locked":
+            raise
+        con.close()
+        print("Database is locked (Firefox may be running).")
+        print("Reading as immutable. The most recent changes may be missing.")
+        con = connect_places(places_file, immutable=True)
+        bookmarks = get_bookmarks(con, host_name, asof)
+    con.close()
+    return bookmarks
+
+
 def exec_sql(cur: sqlite3.Cursor, stmt: str, data=None):
     try:
         if data:
@@ -675,6 +827,14 @@ def exec_sql(cur: sqlite3.Cursor, stmt: str, data=None):
         raise e
 
 
+def exec_sql_many(cur: sqlite3.Cursor, stmt: str, data):
+    try:
+        cur.executemany(stmt, data)
+    except Exception as e:
+        print("\n{}\n".format(stmt))
+        raise e
+
+
 def get_bookmarks_from_db(
     con: sqlite3.Connection,
 ) -> tuple[int, list[Bookmark]]:
@@ -700,10 +860,7 @@ def get_bookmarks_from_db(
 
     exec_sql(cur, qry)
 
-    bookmarks = [
-        Bookmark(row[0], row[1], row[2], row[3], row[4], row[5])
-        for row in cur.fetchall()
-    ]
+    bookmarks = list(map(Bookmark._make, cur))
 
     cur.close()
     return (n_hosts, bookmarks)
@@ -767,6 +924,24 @@ def create_db_objects(con: sqlite3.Connection):
         )
         exec_sql(cur, stmt)
 
+    #  The host_id index serves the view join and the ON DELETE CASCADE when
+    #  a host is updated. The parent_path, title index lets SQLite read the
+    #  bookmarks in order instead of sorting them in get_bookmarks_from_db.
+    if db_object_exists(con, "index", "ix_bookmarks_host_id"):
+        print("Index 'ix_bookmarks_host_id' exists.")
+    else:
+        print("Creating index 'ix_bookmarks_host_id'.")
+        exec_sql(cur, "CREATE INDEX ix_bookmarks_host_id ON bookmarks (host_id);")
+
+    if db_object_exists(con, "index", "ix_bookmarks_path_title"):
+        print("Index 'ix_bookmarks_path_title' exists.")
+    else:
+        print("Creating index 'ix_bookmarks_path_title'.")
+        exec_sql(
+            cur,
+            "CREATE INDEX ix_bookmarks_path_title ON bookmarks (parent_path, title);",
+        )
+
     if db_object_exists(con, "view", "view_bookmarks"):
         print("View 'view_bookmarks' exists.")
     else:
@@ -795,9 +970,12 @@ def create_db_objects(con: sqlite3.Connection):
     cur.close()
 
 
-def insert_bookmarks(
-    con: sqlite3.Connection, opts: AppOptions, bookmarks: list[Bookmark]
-) -> bool:
+def check_host(con: sqlite3.Connection, opts: AppOptions) -> bool:
+    """
+    Returns False if the database already has data for the host, unless
+    updating (--update), in which case the existing data is deleted. The
+    delete is not committed until the new data is inserted.
+    """
     cur = con.cursor()
 
     assert opts.host_name  # noqa: S101
@@ -808,12 +986,20 @@ def insert_bookmarks(
     if row:
         if opts.do_update:
             print(f"\nUpdating data for host '{opts.host_name}'.")
-            exec_sql(cur, f"DELETE FROM hosts WHERE host_name = '{opts.host_name}';")  # noqa: S608
-            con.commit()
+            exec_sql(cur, "DELETE FROM hosts WHERE host_name = ?;", (opts.host_name,))
         else:
             print(f"\nData for host '{opts.host_name}' is already in the database.")
             print("Duplicate data from same host is not allowed.\n")
+            cur.close()
             return False
+    cur.close()
+    return True
+
+
+def insert_bookmarks(
+    con: sqlite3.Connection, opts: AppOptions, bookmarks: list[Bookmark]
+) -> None:
+    cur = con.cursor()
 
     stmt = dedent(
         """
@@ -830,23 +1016,24 @@ def insert_bookmarks(
     )
     exec_sql(cur, stmt, data)
     host_id = cur.lastrowid
-    con.commit()
 
-    for bmk in bookmarks:
-        stmt = dedent(
-            """
-            INSERT INTO bookmarks (
-                host_id, title, url, parent_path, when_added
-            )
-            VALUES (?, ?, ?, ?, ?);
-            """
+    stmt = dedent(
+        """
+        INSERT INTO bookmarks (
+            host_id, title, url, parent_path, when_added
         )
-        data = (host_id, bmk.title, bmk.url, bmk.parent_path, bmk.when_added)
-        exec_sql(cur, stmt, data)
+        VALUES (?, ?, ?, ?, ?);
+        """
+    )
+    data = [
+        (host_id, bmk.title, bmk.url, bmk.parent_path, bmk.when_added)
+        for bmk in bookmarks
+    ]
+    exec_sql_many(cur, stmt, data)
 
+    #  Commit once, so replacing a host's data (--update) is all or nothing.
     con.commit()
     cur.close()
-    return True
 
 
 def get_asof_date(use_mtime: bool, places_file: Path) -> datetime:
@@ -855,6 +1042,37 @@ def get_asof_date(use_mtime: bool, places_file: Path) -> datetime:
     return run_dt
 
 
+def load_bookmarks(opts: AppOptions) -> list[Bookmark]:
+    print(f"Reading {opts.places_file}")
+    asof = get_asof_date(opts.use_mtime, opts.places_file).strftime("%Y-%m-%d %H:%M")
+    bookmarks = read_places_bookmarks(opts.places_file, opts.host_name, asof)
+    print("")
+    return bookmarks
+
+
+def write_db(opts: AppOptions) -> bool:
+    #  Check an existing database for duplicate host data, without changing
+    #  it, before reading the places file.
+    if not opts.do_update and opts.out_db.exists():
+        uri = sqlite_uri(opts.out_db, "mode=ro")
+        with closing(sqlite3.connect(uri, uri=True)) as con:
+            ok = not db_object_exists(con, "table", "hosts") or check_host(con, opts)
+        if not ok:
+            return False
+
+    bookmarks = load_bookmarks(opts)
+
+    print(f"Writing database '{opts.out_db}'")
+    db = sqlite3.connect(str(opts.out_db))
+    create_db_objects(db)
+
+    ok = check_host(db, opts)
+    if ok:
+        insert_bookmarks(db, opts, bookmarks)
+    db.close()
+    return ok
+
+
 def remove_previous_files(from_path: Path, base_name: str) -> None:
     for f in from_path.glob(f"{base_name}*"):
         print(f"Removing '{f}'")
@@ -873,10 +1091,7 @@ def main(arglist=None):
         con = sqlite3.connect(str(opts.in_db))
         n_hosts, bookmarks = get_bookmarks_from_db(con)
 
-        write_bookmarks_html(opts.output_file, bookmarks, opts.cp_dir)
-
-        if opts.md_file:
-            write_bookmarks_markdown(opts.md_file, bookmarks, opts.cp_dir)
+        write_bookmarks_outputs(opts.output_file, bookmarks, opts.cp_dir, opts.md_file)
 
         if opts.bydate_file:
             write_bookmarks_by_date_html(
@@ -884,44 +1099,25 @@ def main(arglist=None):
             )
 
         if opts.md_bydate:
-            write_bookmarks_markdown_by_date(str(opts.md_bydate), n_hosts, bookmarks)
+            write_bookmarks_markdown_by_date(
+                opts.md_bydate, n_hosts, bookmarks, opts.cp_dir
+            )
+    elif opts.out_db:
+        ok = write_db(opts)
     else:
-        print(f"Reading {opts.places_file}")
-        con = sqlite3.connect(str(opts.places_file), timeout=1.0)
-        asof = get_asof_date(opts.use_mtime, opts.places_file).strftime(
-            "%Y-%m-%d %H:%M"
-        )
-        bookmarks = get_bookmarks(con, opts.host_name, asof)
-        con.close()
-        print("")
-
-        if opts.out_db:
-            print(f"Writing database '{opts.out_db}'")
-
-            db = sqlite3.connect(str(opts.out_db))
-            create_db_objects(db)
+        bookmarks = load_bookmarks(opts)
 
-            ok = insert_bookmarks(db, opts, bookmarks)
-            db.close()
-        else:
-            if opts.rm_prev:
-                remove_previous_files(opts.output_file.parent, opts.base_name)
-                remove_previous_files(opts.cp_dir, opts.base_name)
-
-            write_bookmarks_html(opts.output_file, bookmarks, opts.cp_dir)
+        if opts.rm_prev:
+            remove_previous_files(opts.output_file.parent, opts.base_name)
+            remove_previous_files(opts.cp_dir, opts.base_name)
 
-            if opts.md_file:
-                write_bookmarks_markdown(opts.md_file, bookmarks, opts.cp_dir)
+        write_bookmarks_outputs(opts.output_file, bookmarks, opts.cp_dir, opts.md_file)
 
-            if opts.bydate_file:
-                write_bookmarks_by_date_html(
-                    opts.bydate_file, 1, bookmarks, opts.cp_dir
-                )
+        if opts.bydate_file:
+            write_bookmarks_by_date_html(opts.bydate_file, 1, bookmarks, opts.cp_dir)
 
-            if opts.md_bydate:
-                write_bookmarks_markdown_by_date(
-                    opts.md_bydate, 1, bookmarks, opts.cp_dir
-                )
+        if opts.md_bydate:
+            write_bookmarks_markdown_by_date(opts.md_bydate, 1, bookmarks, opts.cp_dir)
 
     if ok:
         print("\nDone.\n")
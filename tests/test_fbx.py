@@ -1,99 +1,119 @@
 from __future__ import annotations
 
 import os
+import shutil
 import sqlite3
-from datetime import datetime, timedelta
-from pathlib import Path
+from datetime import datetime
+from pathlib import Path, PureWindowsPath
 
 import pytest
 
-# from fbx import from_moz_date, get_opts, main
+# from fbx import get_opts, main
 import fbx
 
+#  Local time stamp for 2023-01-02 03:04:05. There is no daylight saving
+#  change in the few days the tests add to it.
+base_ts = datetime(2023, 1, 2, 3, 4, 5).timestamp()
+
+#  moz_places: id, url
+insert_place_sql = "INSERT INTO moz_places VALUES (?, ?);"
+
+#  moz_bookmarks: id, fk, title, parent, dateAdded
+insert_bookmark_sql = "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);"
+
 
 def moz_date(days: int) -> int:
-    base_date: datetime = datetime(2023, 1, 2, 3, 4, 5)
-    d = base_date + timedelta(days=days)
-    #  Convert to milliseconds.
-    return d.timestamp() * 1000000.0
+    #  Convert to microseconds.
+    return int((base_ts + days * 86400) * 1000000)
+
+
+def test_moz_date(setup_tmp_source_and_output):
+    src_file, _ = setup_tmp_source_and_output
+    con = sqlite3.connect(str(src_file))
+    bookmarks = fbx.get_bookmarks(con, "test_host", "2023-01-02 03:04")
+    con.close()
+
+    #  The fake places file adds these bookmarks 0, 4 and 2 days after the
+    #  base date.
+    dates = {bmk.title: bmk.when_added for bmk in bookmarks}
+    assert dates == {
+        "Example Home Page": "2023-01-02 03:04:05",
+        "Example Page 1": "2023-01-06 03:04:05",
+        "Example Page 2": "2023-01-04 03:04:05",
+    }
 
 
-def test_moz_date():
-    md = moz_date(0)
-    assert fbx.from_moz_date(md) == "2023-01-02 03:04:05"
-    md = moz_date(-1)
-    assert fbx.from_moz_date(md) == "2023-01-01 03:04:05"
-    md = moz_date(1)
-    assert fbx.from_moz_date(md) == "2023-01-03 03:04:05"
+def test_ascii_text():
+    assert fbx.ascii_text("Plain title") == "Plain title"
+    assert fbx.ascii_text("Caf\u00e9 \u2713") == "Caf\\xe9 \\u2713"
+    assert fbx.ascii_text("It's") == "It's", "Should not add or strip quotes."
 
 
 def make_fake_places_file(file_path: Path):
     assert not file_path.exists(), "Should be a new file."
 
-    con = sqlite3.connect(str(file_path))
-    cur = con.cursor()
-
-    cur.execute("CREATE TABLE moz_places (id INTEGER, url TEXT);")
+    #  Build the database in memory, then copy it to the file in one go.
+    con = sqlite3.connect(":memory:")
 
-    cur.execute(
+    con.executescript(
+        "CREATE TABLE moz_places (id INTEGER, url TEXT); "
         "CREATE TABLE moz_bookmarks (id INTEGER, fk INTEGER, title TEXT, "
         "parent INTEGER, dateAdded INTEGER);"
     )
 
     #  Insert places (URLs).
-    cur.execute("INSERT INTO moz_places VALUES (?, ?);", (1, "http://www.example.com/"))
-
-    cur.execute(
-        "INSERT INTO moz_places VALUES (?, ?);",
-        (2, "http://www.example.com/page1"),
+    #  moz_places: id, url
+    con.executemany(
+        insert_place_sql,
+        [
+            (1, "http://www.example.com/"),
+            (2, "http://www.example.com/page1"),
+            (3, "http://www.example.com/page2"),
+        ],
     )
 
-    cur.execute(
-        "INSERT INTO moz_places VALUES (?, ?);",
-        (3, "http://www.example.com/page2"),
+    #  moz_bookmarks: id, fk, title, parent, dateAdded
+    con.executemany(
+        insert_bookmark_sql,
+        [
+            #  Entries for menu and folders.
+            (1, None, "menu", 0, moz_date(0)),
+            (2, None, "folder-1", 1, moz_date(0)),
+            (3, None, "folder-2", 1, moz_date(0)),
+            (4, None, "folder-2a", 3, moz_date(0)),
+            #  Entries for bookmarked places.
+            (5, 1, "Example Home Page", 2, moz_date(0)),
+            (6, 2, "Example Page 1", 3, moz_date(4)),
+            (7, 3, "Example Page 2", 4, moz_date(2)),
+        ],
     )
-    #  moz_places: id, url
 
-    #  Insert entries for menu and folders.
-    cur.execute(
-        "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);",
-        (1, None, "menu", 0, moz_date(0)),
-    )
-    cur.execute(
-        "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);",
-        (2, None, "folder-1", 1, moz_date(0)),
-    )
-    cur.execute(
-        "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);",
-        (3, None, "folder-2", 1, moz_date(0)),
-    )
-    cur.execute(
-        "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);",
-        (4, None, "folder-2a", 3, moz_date(0)),
-    )
+    con.commit()
 
-    #  Insert entries for bookmarked places.
-    cur.execute(
-        "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);",
-        (5, 1, "Example Home Page", 2, moz_date(0)),
-    )
-    cur.execute(
-        "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);",
-        (6, 2, "Example Page 1", 3, moz_date(4)),
-    )
-    cur.execute(
-        "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);",
-        (7, 3, "Example Page 2", 4, moz_date(2)),
+    dst = sqlite3.connect(str(file_path))
+    #  The file is throwaway test data, so skip the journal and disk syncs.
+    dst.executescript(
+        "PRAGMA journal_mode = MEMORY; PRAGMA synchronous = OFF; "
+        "PRAGMA temp_store = MEMORY; PRAGMA locking_mode = EXCLUSIVE;"
     )
+    con.backup(dst)
+    dst.close()
+    con.close()
 
-    #  moz_bookmarks: id, fk, title, parent, dateAdded
 
-    con.commit()
-    con.close()
+@pytest.fixture(scope="session")
+def places_template(tmp_path_factory) -> Path:
+    """
+    Builds the fake places.sqlite once per test session. Tests get
+    their own copy of it, so this file is never modified.
+    """
+    template = tmp_path_factory.mktemp("template") / "places.sqlite"
+    make_fake_places_file(template)
+    return template
 
 
 @pytest.fixture()
-def setup_tmp_source_and_output(tmp_path) -> tuple[Path, Path]:
+def setup_tmp_source_and_output(tmp_path, places_template) -> tuple[Path, Path]:
     """
     Creates a fake (well, it's a real sqlite db) places.sqlite to
     simulate one created by Firefox, but with only the fields
@@ -108,14 +128,34 @@ def setup_tmp_source_and_output(tmp_path) -> tuple[Path, Path]:
     src_file = src_dir / "places.sqlite"
     out_dir = tmp_path / "output"
     out_dir.mkdir()
-    make_fake_places_file(src_file)
+    shutil.copyfile(places_template, src_file)
     return (src_file, out_dir)
 
 
-def test_opt_default_profile():
-    args = []
-    opts = fbx.get_opts(args)
-    print(f"\n{opts}")
+@pytest.fixture()
+def setup_wal_source_and_output(setup_tmp_source_and_output) -> tuple[Path, Path]:
+    """
+    Same as setup_tmp_source_and_output, but the places.sqlite file is in
+    WAL mode, as Firefox keeps it.
+    """
+    src_file, out_dir = setup_tmp_source_and_output
+    con = sqlite3.connect(str(src_file))
+    con.execute("PRAGMA journal_mode = WAL;")
+    con.close()
+    return (src_file, out_dir)
+
+
+@pytest.fixture(scope="session")
+def default_opts():
+    """
+    Options from get_opts() with no arguments. This finds the default
+    Firefox profile on the host, so it runs once and is shared.
+    """
+    return fbx.get_opts([])
+
+
+def test_opt_default_profile(default_opts):
+    opts = default_opts
     assert opts.places_file, (
         "This will fail if there is no Firefox profile found on the host in "
         "the expected location. Either the expected location is wrong, or "
@@ -129,14 +169,18 @@ def test_opt_profile(tmp_path: Path):
     p1.mkdir()
     p1 = p1.joinpath("places.sqlite")
     print(f"\n{p1}")
-    make_fake_places_file(p1)
+    #  get_opts only checks that the file exists and when it was modified,
+    #  so an empty file will do.
+    p1.write_bytes(b"")
+    os.utime(p1, (base_ts, base_ts))
 
     #  profile2 will have the newer file.
     p2 = tmp_path.joinpath("profileA")
     p2.mkdir()
     p2 = p2.joinpath("places.sqlite")
     print(f"\n{p2}")
-    make_fake_places_file(p2)
+    p2.write_bytes(b"")
+    os.utime(p2, (base_ts + 60, base_ts + 60))
 
     args = ["--profile", str(tmp_path)]
     opts = fbx.get_opts(args)
@@ -146,54 +190,115 @@ def test_opt_profile(tmp_path: Path):
     )
 
 
+def test_opt_profile_folder(tmp_path: Path, capsys):
+    p1 = tmp_path.joinpath("profile1")
+    p1.mkdir()
+    p1 = p1.joinpath("places.sqlite")
+    p1.write_bytes(b"")
+
+    args = ["--profile", str(p1.parent)]
+    opts = fbx.get_opts(args)
+    assert str(p1) == str(opts.places_file), (
+        "Should find the places.sqlite file when given the profile folder itself."
+    )
+
+    empty = tmp_path.joinpath("empty")
+    empty.mkdir()
+    with pytest.raises(SystemExit):
+        fbx.get_opts(["--profile", str(empty)])
+    captured = capsys.readouterr()
+    assert "ERROR: Cannot find 'places.sqlite'" in captured.err
+
+    with pytest.raises(SystemExit):
+        fbx.get_opts(["--profile", str(p1)])
+    captured = capsys.readouterr()
+    assert "ERROR: Cannot find folder" in captured.err, "Not a folder."
+
+
+def test_ini_places_file(tmp_path: Path):
+    for name in ("abc.default", "xyz.default-release"):
+        d = tmp_path / "Profiles" / name
+        d.mkdir(parents=True)
+        (d / "places.sqlite").write_bytes(b"")
+
+    ini_file = tmp_path / "profiles.ini"
+    assert fbx.get_ini_places_file(ini_file) is None, "No profiles.ini file."
+
+    profiles = (
+        "[Profile1]\nName=default\nIsRelative=1\nPath=Profiles/abc.default\n"
+        "Default=1\n\n"
+        "[Profile0]\nName=default-release\nIsRelative=1\n"
+        "Path=Profiles/xyz.default-release\n\n"
+    )
+    ini_file.write_text(profiles)
+    assert fbx.get_ini_places_file(ini_file) == (
+        tmp_path / "Profiles" / "abc.default" / "places.sqlite"
+    ), "Should use the [Profile] marked Default=1."
+
+    ini_file.write_text(
+        "[Install4F96D1932A9F858E]\nDefault=Profiles/xyz.default-release\n"
+        "Locked=1\n\n" + profiles
+    )
+    assert fbx.get_ini_places_file(ini_file) == (
+        tmp_path / "Profiles" / "xyz.default-release" / "places.sqlite"
+    ), "The [Install] default should take precedence."
+
+    ini_file.write_bytes(b"[Profile0]\nName=caf\xe9\nDefault=1\n")
+    assert fbx.get_ini_places_file(ini_file) is None, "Not valid UTF-8."
+
+
 def test_opt_places_file(tmp_path: Path):
     p1 = tmp_path.joinpath("profile1")
     p1.mkdir()
     p1 = p1.joinpath("places.sqlite")
     print(f"\n{p1}")
-    make_fake_places_file(p1)
+    p1.write_bytes(b"")
+    os.utime(p1, (base_ts, base_ts))
 
     #  profile2 will have the newer file.
     p2 = tmp_path.joinpath("profile2")
     p2.mkdir()
     p2 = p2.joinpath("places.sqlite")
     print(f"\n{p2}")
-    make_fake_places_file(p2)
+    p2.write_bytes(b"")
+    os.utime(p2, (base_ts + 60, base_ts + 60))
 
     args = ["--profile", str(p2.parent), "--places-file", str(p1)]
     opts = fbx.get_opts(args)
     assert str(p1) == str(opts.places_file), "--places-file should override --profile"
 
 
-def test_opt_default_output():
-    args = []
-    opts = fbx.get_opts(args)
-    print(f"\n{opts}")
+def test_opt_default_output(default_opts):
+    opts = default_opts
     assert isinstance(opts.output_file, Path)
     assert "Desktop" in str(opts.output_file)
 
 
-def test_opt_output_name():
-    args = ["--output-name", "myname.txt"]
+def test_opt_output_name(places_template):
+    args = ["--places-file", str(places_template), "--output-name", "myname.txt"]
     opts = fbx.get_opts(args)
-    print(f"\n{opts}")
     assert opts.output_file.name == "myname.html", (
         "File name suffix should always be '.html'."
     )
 
 
-def test_opt_md_output_names():
-    args = ["--output-name", "myname.txt", "--by-date", "--md"]
+def test_opt_md_output_names(places_template):
+    args = [
+        "--places-file",
+        str(places_template),
+        "--output-name",
+        "myname.txt",
+        "--by-date",
+        "--md",
+    ]
     opts = fbx.get_opts(args)
-    print(f"\n{opts}")
     assert opts.md_file.name == "myname.md"
     assert opts.md_bydate.name == "myname-bydate.md"
 
 
-def test_opt_output_folder(tmp_path):
-    args = ["--output-folder", str(tmp_path)]
+def test_opt_output_folder(tmp_path, places_template):
+    args = ["--places-file", str(places_template), "--output-folder", str(tmp_path)]
     opts = fbx.get_opts(args)
-    print(f"\n{opts}")
     assert str(opts.output_file.parent) == str(tmp_path), (
         "Output file should be in specified folder."
     )
@@ -213,9 +318,30 @@ def test_html_output(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
     assert (out_dir / "test-fbx-output.html").exists()
     assert (out_dir / "test-fbx-output-bydate.html").exists()
+    bydate_text = (out_dir / "test-fbx-output-bydate.html").read_text("utf-8")
+    assert ">Example Page 1<" in bydate_text, "Titles should not be quoted."
+
+
+def test_html_output_parent_paths(setup_tmp_source_and_output):
+    src_file, out_dir = setup_tmp_source_and_output
+    args = [
+        "--places-file",
+        str(src_file),
+        "--output-folder",
+        str(out_dir),
+        "--output-name",
+        "test-fbx-output.html",
+    ]
+    result = fbx.main(args)
+    assert result == 0
+    text = (out_dir / "test-fbx-output.html").read_text()
+    assert "/folder-1/" in text
+    assert "/folder-2/" in text
+    assert "/folder-2/folder-2a/" in text
+    assert "/menu/" not in text, "The root folder should not be in the path."
 
 
 def test_html_output_w_copy(setup_tmp_source_and_output, capsys):
@@ -236,7 +362,7 @@ def test_html_output_w_copy(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
     assert (cp_dir / "test-fbx-output.html").exists()
     assert (cp_dir / "test-fbx-output-bydate.html").exists()
 
@@ -280,7 +406,7 @@ def test_markdown_output(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
     assert out_md.exists()
     assert (out_dir / "test-fbx-output-bydate.md").exists()
 
@@ -305,7 +431,7 @@ def test_markdown_output_w_copy(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
     assert (cp_dir / "test-fbx-output.md").exists()
     assert (cp_dir / "test-fbx-output-bydate.md").exists()
 
@@ -341,7 +467,7 @@ def test_outputs_w_rm_prev(setup_tmp_source_and_output, capsys, monkeypatch):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
     out_files = [x for x in out_dir.glob("*") if x.is_file()]
     assert len(out_files) == 4
     cp_files = list(cp_dir.glob("*"))
@@ -353,7 +479,7 @@ def test_outputs_w_rm_prev(setup_tmp_source_and_output, capsys, monkeypatch):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
     out_files = [x for x in out_dir.glob("*") if x.is_file()]
     assert len(out_files) == 4
     cp_files = list(cp_dir.glob("*"))
@@ -378,7 +504,7 @@ def test_db_output(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
 
     #  Read the same places.sqlite file and write to the same sqlite database.
     args = [
@@ -392,6 +518,7 @@ def test_db_output(setup_tmp_source_and_output, capsys):
     captured = capsys.readouterr()
     assert result == 1
     assert " already in " in captured.out, "Should not load duplicate data."
+    assert "Reading " not in captured.out, "Should check before reading."
 
     #  Read the same places.sqlite file and write to the same sqlite database,
     #  but say it's from a different host (--host-name parameter).
@@ -406,7 +533,7 @@ def test_db_output(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
 
     #  Read the sqlite database and write HTML files.
     args = [
@@ -420,11 +547,28 @@ def test_db_output(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
 
     html_path = out_dir / "test-fbx-output-from-db.html"
     assert html_path.exists()
-    assert "other_host" in html_path.read_text()
+    assert b"other_host" in html_path.read_bytes()
+
+    #  Read the sqlite database and write Markdown files, including by-date.
+    args = [
+        "--output-folder",
+        str(out_dir),
+        f"--from-sqlite={out_dir}/test-fbx-db-output.sqlite",
+        "--output-name",
+        "test-fbx-output-from-db.html",
+        "--by-date",
+        "--md",
+    ]
+    result = fbx.main(args)
+    captured = capsys.readouterr()
+    assert result == 0
+    assert captured.out.rstrip().endswith("Done.")
+    assert (out_dir / "test-fbx-output-from-db.md").exists()
+    assert (out_dir / "test-fbx-output-from-db-bydate.md").exists()
 
 
 def test_use_places_file_timestamp(setup_tmp_source_and_output, capsys):
@@ -447,7 +591,7 @@ def test_use_places_file_timestamp(setup_tmp_source_and_output, capsys):
     captured = capsys.readouterr()
 
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
 
     files = list(out_dir.glob("*.html"))
     assert len(files) == 1
@@ -456,7 +600,151 @@ def test_use_places_file_timestamp(setup_tmp_source_and_output, capsys):
     # Should get 'as of' date-time from the places.file last modified
     # timestamp when the '--asof-mtime' option is used.
     assert f"{dt.strftime('%y%m%d_%H%M')}" in out_file.name
-    assert f" as of {dt.strftime('%Y-%m-%d %H:%M')}" in out_file.read_text()
+    asof = f" as of {dt.strftime('%Y-%m-%d %H:%M')}"
+    assert asof.encode() in out_file.read_bytes()
+
+
+def test_skip_non_http_urls(setup_tmp_source_and_output, capsys):
+    src_file, _ = setup_tmp_source_and_output
+
+    con = sqlite3.connect(str(src_file))
+    cur = con.cursor()
+    #  moz_places: id, url
+    cur.execute(insert_place_sql, (5, "place:sort=8"))
+    #  moz_bookmarks: id, fk, title, parent, dateAdded
+    cur.execute(insert_bookmark_sql, (8, 5, "Most Visited", 2, moz_date(1)))
+    con.commit()
+    cur.close()
+
+    bookmarks = fbx.get_bookmarks(con, "test_host", "2023-01-02 03:04")
+    con.close()
+    captured = capsys.readouterr()
+
+    assert len(bookmarks) == 3
+    assert all(bmk.url.startswith("http") for bmk in bookmarks)
+    assert "Skipped 1 non-http URLs." in captured.out
+
+
+def test_untitled_bookmark(setup_tmp_source_and_output):
+    src_file, _ = setup_tmp_source_and_output
+
+    con = sqlite3.connect(str(src_file))
+    cur = con.cursor()
+    cur.execute(insert_place_sql, (5, "https://untitled/"))
+    cur.execute(insert_bookmark_sql, (8, 5, None, 2, moz_date(1)))
+    con.commit()
+    cur.close()
+
+    bookmarks = fbx.get_bookmarks(con, "test_host", "2023-01-02 03:04")
+    con.close()
+
+    titles = [bmk.title for bmk in bookmarks if bmk.url == "https://untitled/"]
+    assert titles == ["(https://untitled/)"]
+
+
+def test_bookmark_without_folder_path(setup_tmp_source_and_output, capsys):
+    src_file, _ = setup_tmp_source_and_output
+
+    con = sqlite3.connect(str(src_file))
+    #  A chain of 100 folders below folder-1, deeper than the depth limit.
+    con.executemany(
+        insert_bookmark_sql,
+        [(100 + i, None, f"deep-{i}", 2 if i == 0 else 99 + i, 0) for i in range(100)],
+    )
+    con.executemany(insert_place_sql, [(5, "https://deep/"), (6, "https://orphan/")])
+    con.executemany(
+        insert_bookmark_sql,
+        [
+            (8, 5, "Deep", 199, moz_date(1)),
+            #  The parent folder does not exist.
+            (9, 6, "Orphan", 999, moz_date(1)),
+        ],
+    )
+    con.commit()
+
+    bookmarks = fbx.get_bookmarks(con, "test_host", "2023-01-02 03:04")
+    con.close()
+
+    assert len(bookmarks) == 5, "Should not drop bookmarks without a path."
+    paths = {bmk.title: bmk.parent_path for bmk in bookmarks}
+    assert paths["Deep"] == "/(ERROR)/"
+    assert paths["Orphan"] == "/(ERROR)/"
+    captured = capsys.readouterr()
+    assert "ERROR: Cannot find the folder path for 2 bookmarks" in captured.out
+
+
+def test_sqlite_uri(setup_tmp_source_and_output):
+    unc_file = PureWindowsPath(r"\\server\share\Firefox\places.sqlite")
+    assert fbx.sqlite_uri(unc_file, "mode=ro") == (
+        "file:%5C%5Cserver%5Cshare%5CFirefox%5Cplaces.sqlite?mode=ro"
+    ), "Should not have a URI authority part."
+
+    #  Characters with a meaning in a URI must not end the path.
+    src_file, out_dir = setup_tmp_source_and_output
+    odd_file = out_dir / "places #1?.sqlite"
+    shutil.copyfile(src_file, odd_file)
+    con = fbx.connect_places(odd_file)
+    bookmarks = fbx.get_bookmarks(con, "test_host", "2023-01-02 03:04")
+    con.close()
+    assert len(bookmarks) == 3
+
+
+def test_read_wal_places_file(setup_wal_source_and_output, capsys):
+    src_file, out_dir = setup_wal_source_and_output
+    assert [f.name for f in src_file.parent.iterdir()] == ["places.sqlite"]
+
+    args = [
+        "--places-file",
+        str(src_file),
+        "--output-folder",
+        str(out_dir),
+        "--by-date",
+    ]
+    result = fbx.main(args)
+    captured = capsys.readouterr()
+    assert result == 0
+    assert captured.out.rstrip().endswith("Done.")
+    assert [f.name for f in src_file.parent.iterdir()] == ["places.sqlite"], (
+        "Should not leave WAL or shared-memory files next to places.sqlite."
+    )
+
+
+def test_read_locked_places_file(setup_tmp_source_and_output, capsys, monkeypatch):
+    src_file, out_dir = setup_tmp_source_and_output
+
+    connect_places = fbx.connect_places
+    calls = []
+
+    def fake_connect_places(places_file: Path, immutable=False):
+        calls.append(immutable)
+        con = connect_places(places_file, immutable)
+        #  Fail at once instead of waiting for the lock to be released.
+        con.execute("PRAGMA busy_timeout = 0;")
+        return con
+
+    monkeypatch.setattr("fbx.connect_places", fake_connect_places)
+
+    #  Hold an exclusive lock, as a running Firefox would.
+    lock_con = sqlite3.connect(str(src_file))
+    lock_con.execute("BEGIN EXCLUSIVE;")
+    try:
+        bookmarks = fbx.read_places_bookmarks(src_file, "test_host", "2023-01-02")
+    finally:
+        lock_con.rollback()
+        lock_con.close()
+
+    assert calls == [False, True], "Should retry as immutable."
+    assert len(bookmarks) == 3
+    captured = capsys.readouterr()
+    assert "Database is locked" in captured.out
+
+    #  Other errors are not retried.
+    bad_file = out_dir / "places.sqlite"
+    bad_file.write_bytes(b"")
+    calls.clear()
+    with pytest.raises(sqlite3.OperationalError, match="no such table"):
+        fbx.read_places_bookmarks(bad_file, "test_host", "2023-01-02")
+    assert calls == [False]
 
 
 def get_db_table_row_count(db_path: Path, table_name: str) -> int:
@@ -490,7 +778,7 @@ def test_db_output_update_by_host(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
 
     n_rows = get_db_table_row_count(out_db, "bookmarks")
     assert n_rows == 3
@@ -508,7 +796,7 @@ def test_db_output_update_by_host(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
     n_rows = get_db_table_row_count(out_db, "bookmarks")
     assert n_rows == 6
 
@@ -516,15 +804,9 @@ def test_db_output_update_by_host(setup_tmp_source_and_output, capsys):
     con = sqlite3.connect(str(src_file))
     cur = con.cursor()
     #  moz_places: id, url
-    cur.execute(
-        "INSERT INTO moz_places VALUES (?, ?);",
-        (4, "http://www.example.com/page3"),
-    )
+    cur.execute(insert_place_sql, (4, "http://www.example.com/page3"))
     #  moz_bookmarks: id, fk, title, parent, dateAdded
-    cur.execute(
-        "INSERT INTO moz_bookmarks VALUES (?, ?, ?, ?, ?);",
-        (7, 4, "Example Page 3", 4, moz_date(3)),
-    )
+    cur.execute(insert_bookmark_sql, (7, 4, "Example Page 3", 4, moz_date(3)))
     con.commit()
     cur.close()
     con.close()
@@ -543,6 +825,67 @@ def test_db_output_update_by_host(setup_tmp_source_and_output, capsys):
     result = fbx.main(args)
     captured = capsys.readouterr()
     assert result == 0
-    assert "Done." in captured.out
+    assert captured.out.rstrip().endswith("Done.")
     n_rows = get_db_table_row_count(out_db, "bookmarks")
     assert n_rows == 7
+
+
+def test_db_output_failed_read(setup_tmp_source_and_output, capsys):
+    src_file, out_dir = setup_tmp_source_and_output
+    out_db = out_dir / "test-fbx-db-output.sqlite"
+    bad_file = out_dir / "places.sqlite"
+    bad_file.write_bytes(b"")
+
+    def db_args(places_file: Path) -> list[str]:
+        return [
+            "--places-file",
+            str(places_file),
+            "--output-folder",
+            str(out_dir),
+            f"--output-sqlite={out_db.name}",
+        ]
+
+    with pytest.raises(sqlite3.OperationalError):
+        fbx.main(db_args(bad_file))
+    assert not out_db.exists(), "Should not create the database if the read fails."
+
+    result = fbx.main(db_args(src_file))
+    assert result == 0
+    assert get_db_table_row_count(out_db, "bookmarks") == 3
+    capsys.readouterr()
+
+    with pytest.raises(sqlite3.OperationalError):
+        fbx.main([*db_args(bad_file), "--update"])
+    assert get_db_table_row_count(out_db, "hosts") == 1
+    assert get_db_table_row_count(out_db, "bookmarks") == 3, (
+        "A failed read should not remove the existing data."
+    )
+
+
+def test_db_output_not_a_database(setup_tmp_source_and_output, monkeypatch):
+    src_file, out_dir = setup_tmp_source_and_output
+    out_db = out_dir / "test-fbx-db-output.sqlite"
+    out_db.write_bytes(b"This is not a database. " * 100)
+
+    connect = sqlite3.connect
+    cons = []
+
+    def fake_connect(*args, **kwargs):
+        con = connect(*args, **kwargs)
+        cons.append(con)
+        return con
+
+    monkeypatch.setattr("fbx.sqlite3.connect", fake_connect)
+
+    args = [
+        "--places-file",
+        str(src_file),
+        "--output-folder",
+        str(out_dir),
+        f"--output-sqlite={out_db.name}",
+    ]
+    with pytest.raises(sqlite3.DatabaseError, match="not a database"):
+        fbx.main(args)
+    assert len(cons) == 1
+    with pytest.raises(sqlite3.ProgrammingError):
+        cons[0].execute("SELECT 1;")